@@ -1,19 +1,43 @@
 import gspread
+from gspread.utils import absolute_range_name
 from oauth2client.service_account import ServiceAccountCredentials
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import time
+import json
 import random
 import logging
+import numpy as np
+
+try:
+    import orjson  # Optional: faster decoding of large Sheets API responses
+except ImportError:
+    orjson = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+
+def _orjson_response_hook(response, *args, **kwargs):
+    """
+    requests response hook that makes response.json() decode with orjson instead of the stdlib json module.
+    """
+    response.json = lambda **_: orjson.loads(response.content)
+    return response
+
+
 # === CONFIGURATION ===
 SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
 
 try:
     CREDS = ServiceAccountCredentials.from_json_keyfile_name("credentials.json", SCOPE)
     client = gspread.authorize(CREDS)
+
+    # gspread's authorized session is a requests.Session, which already keeps connections alive; its default
+    # pool (pool_maxsize=10) also covers the concurrent participant flush (PARTICIPANT_FLUSH_WORKERS)
+    if orjson is not None:
+        client.http_client.session.hooks["response"].append(_orjson_response_hook)
     logging.info("Successfully authenticated with Google Sheets API.")
 except Exception as e:
     logging.error(
@@ -40,6 +64,16 @@ INITIAL_COMPANY_PRICES = {
     "ULTRATECH": 12100.00,
 }
 
+# Set of known company names for fast membership checks in the per-cycle loops
+_KNOWN_COMPANIES = frozenset(INITIAL_COMPANY_PRICES)
+
+# Random generator for the per-cycle price fluctuation
+_RNG = np.random.default_rng()
+
+# Circuit breaker factors applied to the current price (±20%)
+UPPER_CIRCUIT_FACTOR = 1.20
+LOWER_CIRCUIT_FACTOR = 0.80
+
 # Dictionary to store previous prices for Change % calculation: {company: previous_price}
 PREVIOUS_PRICES = {company: price for company, price in INITIAL_COMPANY_PRICES.items()}
 
@@ -51,8 +85,39 @@ LAST_TRADED_PRICES = {company: price for company, price in
 CURRENT_VWAP_PRICES = {company: price for company, price in
                        INITIAL_COMPANY_PRICES.items()}
 
-# Dictionary to store recent trades for VWAP calculation: {company: [(price, quantity), (price, quantity), ...]}
-RECENT_TRADES_HISTORY = {company: [] for company in INITIAL_COMPANY_PRICES.keys()}
+
+class TradeWindow:
+    """
+    Holds the most recent trades (price, quantity) for a company and keeps running
+    sums of price*quantity and quantity so the VWAP is available in O(1).
+    """
+
+    def __init__(self, maxlen=3):
+        self._trades = deque(maxlen=maxlen)
+        self._num = 0.0
+        self._den = 0
+
+    def push(self, price, qty):
+        if len(self._trades) == self._trades.maxlen:
+            old_price, old_qty = self._trades[0]
+            self._num -= old_price * old_qty
+            self._den -= old_qty
+        self._trades.append((price, qty))
+        self._num += price * qty
+        self._den += qty
+
+    def clear(self):
+        self._trades.clear()
+        self._num = 0.0
+        self._den = 0
+
+    @property
+    def vwap(self):
+        return self._num / self._den if self._den > 0 else None
+
+
+# Dictionary to store the last 3 trades for VWAP calculation: {company: TradeWindow}
+RECENT_TRADES_HISTORY = {company: TradeWindow(maxlen=3) for company in INITIAL_COMPANY_PRICES.keys()}
 
 # Dictionary to store current volume for each company
 COMPANY_VOLUME = {company: 0 for company in INITIAL_COMPANY_PRICES.keys()}
@@ -62,23 +127,66 @@ CURRENT_CIRCUITS = {company: {"upper": 0.0, "lower": 0.0} for company in INITIAL
 
 # === SHEET HELPER FUNCTIONS ===
 
-# Global cache for worksheets to avoid opening them repeatedly in a single cycle
+# Transient Sheets API failures (quota exceeded / server errors) that are worth retrying
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# Non-idempotent calls (append_rows) may already have been applied when a 5xx comes back,
+# so they are only retried when the request was rejected outright by the quota limiter
+NON_IDEMPOTENT_RETRY_CODES = {429}
+BACKOFF_MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 8.0
+
+
+def _call_with_backoff(fn, *args, retry_codes=RETRYABLE_STATUS_CODES, **kwargs):
+    """
+    Calls a gspread function, retrying with bounded exponential backoff (plus jitter) when the
+    Sheets API answers with a status in retry_codes. Honours the Retry-After header when present.
+    Any other error, or the last failed attempt, is re-raised to the caller.
+    Pass retry_codes=NON_IDEMPOTENT_RETRY_CODES for calls that must not be repeated after a server error.
+    """
+    for attempt in range(BACKOFF_MAX_ATTEMPTS):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            # gspread 6.0.2's APIError only carries the HTTP response, not a status code attribute
+            status_code = e.response.status_code if e.response is not None else None
+            if status_code not in retry_codes or attempt == BACKOFF_MAX_ATTEMPTS - 1:
+                raise
+            delay = min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt) + random.random() * 0.25
+            retry_after = e.response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    delay = max(delay, float(retry_after))
+                except ValueError:
+                    pass
+            logging.warning(
+                f"Sheets API returned {status_code} for {getattr(fn, '__name__', fn)}. "
+                f"Retrying in {delay:.2f}s (attempt {attempt + 1}/{BACKOFF_MAX_ATTEMPTS}).")
+            time.sleep(delay)
+
+
+# Global cache for worksheets to avoid opening them repeatedly: {url_or_name: (worksheet, expiry_ts)}
 _WORKSHEET_CACHE = {}
+WORKSHEET_CACHE_TTL_SECONDS = 60
 
 
 def get_worksheet(sheet_name_or_url):
     """
     Opens a Google Sheet by its URL and returns the first worksheet (sheet1).
-    This function caches worksheets to avoid reopening them within the same run.
+    This function caches worksheets across cycles and only reopens them once the
+    cached entry is older than WORKSHEET_CACHE_TTL_SECONDS.
     """
-    if sheet_name_or_url not in _WORKSHEET_CACHE:
+    cached = _WORKSHEET_CACHE.get(sheet_name_or_url)
+    if cached is None or time.monotonic() >= cached[1]:
         try:
             if sheet_name_or_url.startswith("http"):
-                spreadsheet = client.open_by_url(sheet_name_or_url)
+                spreadsheet = _call_with_backoff(client.open_by_url, sheet_name_or_url)
             else:
-                spreadsheet = client.open(sheet_name_or_url)
+                spreadsheet = _call_with_backoff(client.open, sheet_name_or_url)
 
-            _WORKSHEET_CACHE[sheet_name_or_url] = spreadsheet.sheet1
+            # spreadsheet.sheet1 fetches the sheet metadata over the API, so it goes through the backoff too
+            worksheet = _call_with_backoff(spreadsheet.get_worksheet, 0)
+            _WORKSHEET_CACHE[sheet_name_or_url] = (worksheet, time.monotonic() + WORKSHEET_CACHE_TTL_SECONDS)
             logging.debug(
                 f"DEBUG: Successfully opened and cached new spreadsheet '{spreadsheet.title}' from URL/name: {sheet_name_or_url} (API call).")
         except gspread.exceptions.SpreadsheetNotFound:
@@ -89,60 +197,108 @@ def get_worksheet(sheet_name_or_url):
             raise
     else:
         logging.debug(
-            f"DEBUG: Retrieving spreadsheet '{_WORKSHEET_CACHE[sheet_name_or_url].title}' from cache (no API call).")
-    return _WORKSHEET_CACHE[sheet_name_or_url]
+            f"DEBUG: Retrieving spreadsheet '{cached[0].title}' from cache (no API call).")
+    return _WORKSHEET_CACHE[sheet_name_or_url][0]
+
+
+# Participant sheet block covering cash (row 2) through the holdings table (rows 6-14)
+PARTICIPANT_BLOCK_RANGE = "A2:B14"
+PARTICIPANT_BLOCK_ROWS = 13
+HOLDINGS_BLOCK_OFFSET = 4  # Block index of sheet row 6 (start of the holdings table)
 
 
-def get_cash_balance(ws):
+def fetch_participant_blocks(participant_names):
     """
-    Retrieves the cash balance from a specific cell (B2) of the given worksheet.
+    Reads the A2:B14 block for every given participant using one values.batchGet per spreadsheet.
+    Returns a dictionary {participant_name: block}, where block is the raw 2D list padded to
+    13 rows x 2 columns (or None if the sheet could not be read).
     """
+    participants_by_url = {}
+    for participant_name in participant_names:
+        participants_by_url.setdefault(SHEET_MAPPING[participant_name], []).append(participant_name)
+
+    blocks = {}
+    for url, names in participants_by_url.items():
+        try:
+            ws = get_worksheet(url)
+            response = _call_with_backoff(ws.spreadsheet.values_batch_get,
+                                          [absolute_range_name(ws.title, PARTICIPANT_BLOCK_RANGE)],
+                                          params={'valueRenderOption': 'UNFORMATTED_VALUE', 'majorDimension': 'ROWS'})
+            rows = response.get('valueRanges', [{}])[0].get('values', [])
+            block = [list(row) + [""] * (2 - len(row)) for row in rows]
+            block += [["", ""] for _ in range(PARTICIPANT_BLOCK_ROWS - len(block))]
+            for participant_name in names:
+                blocks[participant_name] = block
+        except Exception as e:
+            logging.error(f"Error fetching {PARTICIPANT_BLOCK_RANGE} for participants {names}: {e}")
+            for participant_name in names:
+                blocks[participant_name] = None
+    return blocks
+
+
+def get_cash_balance(block, sheet_label):
+    """
+    Retrieves the cash balance (B2) from a participant block fetched by fetch_participant_blocks.
+    The block is read unformatted, so a numeric cell is already a number.
+    """
+    cash = block[0][1]
+    if cash is None or cash == "":
+        logging.warning(f"Cash balance cell B2 is empty for worksheet '{sheet_label}'. Returning 0.0.")
+        return 0.0
     try:
-        cash_str = ws.acell("B2").value
-        if cash_str is None or cash_str.strip() == "":
-            logging.warning(f"Cash balance cell B2 is empty for worksheet '{ws.title}'. Returning 0.0.")
-            return 0.0
-        return float(cash_str)
+        return float(cash)
     except (ValueError, TypeError) as e:
         logging.warning(
-            f"Could not convert cash balance in B2 ('{cash_str}') to float for worksheet '{ws.title}'. Returning 0.0. Error: {e}")
-        return 0.0
-    except Exception as e:
-        logging.error(f"Error retrieving cash balance from worksheet '{ws.title}': {e}")
+            f"Could not convert cash balance in B2 ('{cash}') to float for worksheet '{sheet_label}'. Returning 0.0. Error: {e}")
         return 0.0
 
 
-def get_holdings(ws):
+def get_holding_rows(block):
+    """
+    Maps each company in the holdings table (A6:B14) of a participant block to its sheet row number.
+    """
+    holding_rows = {}
+    for r_idx, row in enumerate(block[HOLDINGS_BLOCK_OFFSET:], start=HOLDINGS_BLOCK_OFFSET):
+        company_name = str(row[0]).strip().upper()
+        if company_name and company_name != "COMPANY":
+            holding_rows[company_name] = r_idx + 2  # Block index 0 is sheet row 2
+    return holding_rows
+
+
+def parse_quantity(value):
+    """
+    Converts an unformatted quantity cell to an int.
+    Fractional numbers are rejected with a ValueError instead of being truncated by int().
+    """
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"quantity {value} is not a whole number")
+    return int(value)
+
+
+def get_holdings(block, sheet_label):
     """
-    Retrieves company holdings from a specified range (A6:B14) of the worksheet.
+    Retrieves company holdings (A6:B14) from a participant block fetched by fetch_participant_blocks.
     It parses the data into a dictionary: {company_name: quantity}.
     """
     holdings = {}
-    try:
-        data = ws.get("A6:B14")  # CHECK THIS RANGE IN YOUR ACTUAL SHEETS
-    except Exception as e:
-        logging.error(f"Error fetching holdings data from range A6:B14 for worksheet '{ws.title}': {e}")
-        return {}
-    for row in data:
-        if len(row) < 2 or row[0].strip().lower() == "company":
+    for row in block[HOLDINGS_BLOCK_OFFSET:]:
+        company_name = str(row[0]).strip().upper()
+        if not company_name or company_name == "COMPANY":
             continue
         try:
-            company_name = row[0].strip().upper()
-            quantity_str = row[1].strip() if len(row) > 1 else "0"
-            quantity = int(quantity_str) if quantity_str else 0
-            holdings[company_name] = quantity
-        except (ValueError, IndexError) as e:
+            holdings[company_name] = parse_quantity(row[1] or 0)
+        except (ValueError, TypeError) as e:
             logging.warning(
-                f"Could not parse holding row '{row}' for worksheet '{ws.title}'. Setting quantity to 0. Error: {e}")
-            holdings[row[0].strip().upper()] = 0
+                f"Could not parse holding row '{row}' for worksheet '{sheet_label}'. Setting quantity to 0. Error: {e}")
+            holdings[company_name] = 0
     return holdings
 
 
-def prepare_transaction_row(action, company, qty, price, total):
+def prepare_transaction_row(timestamp, action, company, qty, price, total):
     """
     Prepares a transaction record as a new row for later batch appending.
+    The timestamp is formatted once per cycle by the caller and shared by every row in the batch.
     """
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     return [timestamp, action, company, qty, price, total]
 
 
@@ -153,49 +309,42 @@ def calculate_vwap(company):
     Calculates the Volume Weighted Average Price (VWAP) for a given company
     based on the last 3 trades stored in RECENT_TRADES_HISTORY.
     """
-    trades = RECENT_TRADES_HISTORY.get(company, [])
-    if not trades:
-        return None
-
-    total_price_volume = 0
-    total_volume = 0
-    for price, qty in trades:
-        total_price_volume += price * qty
-        total_volume += qty
-
-    return total_price_volume / total_volume if total_volume > 0 else None
+    trade_window = RECENT_TRADES_HISTORY.get(company)
+    return trade_window.vwap if trade_window is not None else None
 
 
 def get_manual_overrides(admin_ws):
     """
     Reads manual override requests from the Admin_Controls sheet.
-    Returns a dictionary: {company_name: override_price} for active overrides.
+    Returns a tuple (overrides, updates_to_clear_checkboxes): overrides is {company_name: override_price}
+    for active overrides, and the checkbox clears are left to the caller to write after the price update.
     """
     overrides = {}
+    updates_to_clear_checkboxes = []
     try:
-        admin_data = admin_ws.get("A4:C11")
-        updates_to_clear_checkboxes = []
+        admin_data = _call_with_backoff(admin_ws.get, "A4:C11", value_render_option='UNFORMATTED_VALUE')
 
         for i, row in enumerate(admin_data):
             if len(row) >= 3:
-                company = row[0].strip().upper()
-                override_price_str = row[1].strip()
-                apply_override_checkbox = row[2].strip()
+                company = str(row[0]).strip().upper()
+                override_price_value = row[1]
+                apply_override_checkbox = str(row[2]).strip()
 
-                if apply_override_checkbox.upper() == 'TRUE' and company and override_price_str:
+                if apply_override_checkbox.upper() == 'TRUE' and company and override_price_value != "":
                     try:
-                        override_price = float(override_price_str)
+                        override_price = float(override_price_value)
                         overrides[company] = override_price
                         updates_to_clear_checkboxes.append({'range': f'C{i + 4}', 'values': [['FALSE']]})
-                    except ValueError:
-                        logging.warning(f"Invalid override price '{override_price_str}' for company '{company}'.")
-
-        if updates_to_clear_checkboxes:
-            admin_ws.batch_update(updates_to_clear_checkboxes)
-            logging.info(f"Cleared {len(updates_to_clear_checkboxes)} manual override checkboxes.")
+                    except (ValueError, TypeError):
+                        logging.warning(f"Invalid override price '{override_price_value}' for company '{company}'.")
     except Exception as e:
         logging.error(f"Error reading manual overrides from Admin_Controls sheet: {e}")
-    return overrides
+    return overrides, updates_to_clear_checkboxes
+
+
+# Set when a trade executes; the Price Chart is only rewritten when prices are dirty or an override is pending.
+# Starts True so the first call after startup always writes the initial prices.
+_dirty_prices = True
 
 
 def update_price_chart():
@@ -203,35 +352,47 @@ def update_price_chart():
     Updates the 'Price_Chart' sheet with current prices, LTP, volume, change, and circuits.
     Handles manual overrides.
     Populates CURRENT_VWAP_PRICES and CURRENT_CIRCUITS global variables.
+    Skips the update entirely when no trade executed since the last write and no override is pending.
     """
+    global _dirty_prices
     logging.info("\n--- Updating Price Chart ---")
     try:
         price_chart_ws = get_worksheet(SHEET_MAPPING["Price_Chart"])
         admin_ws = get_worksheet(SHEET_MAPPING["Admin_Controls"])
 
-        price_data_from_sheet = price_chart_ws.get_all_values()
-        manual_overrides = get_manual_overrides(admin_ws)
+        manual_overrides, pending_admin_updates = get_manual_overrides(admin_ws)
+        if not manual_overrides and not _dirty_prices:
+            logging.debug("DEBUG: No trades or manual overrides since last update. Skipping Price Chart update.")
+            return
 
-        updates = []
+        price_data_from_sheet = _call_with_backoff(price_chart_ws.get_all_values,
+                                                   value_render_option='UNFORMATTED_VALUE')
+
+        ip_get = INITIAL_COMPANY_PRICES.get
+        ltp_get = LAST_TRADED_PRICES.get
+        vwap_get = CURRENT_VWAP_PRICES.get
+
+        overridden_rows = []
+        fluctuating_rows = []
         for i, row in enumerate(price_data_from_sheet):
             if i == 0:
                 continue
 
-            company_name = row[0].strip().upper()
+            company_name = str(row[0]).strip().upper()
             if not company_name:
                 break
 
-            if company_name not in INITIAL_COMPANY_PRICES:
+            if company_name not in _KNOWN_COMPANIES:
                 logging.warning(
                     f"Company '{company_name}' from Price_Chart not found in INITIAL_COMPANY_PRICES. Skipping price update for this company.")
                 continue
 
             # Robustly get previous_price_for_change
-            previous_price_for_change = INITIAL_COMPANY_PRICES.get(company_name, 0.0)
+            initial_price = ip_get(company_name, 0.0)
+            previous_price_for_change = initial_price
             try:
-                if len(row) > 1 and row[1].strip():
-                    sheet_live_price_str = row[1].strip().replace('%', '')
-                    sheet_price = float(sheet_live_price_str)
+                if len(row) > 1 and row[1] != "":
+                    sheet_price = float(row[1])
                     if sheet_price > 0:
                         previous_price_for_change = sheet_price
                     else:
@@ -245,39 +406,44 @@ def update_price_chart():
 
             PREVIOUS_PRICES[company_name] = previous_price_for_change
 
-            current_ltp = LAST_TRADED_PRICES.get(company_name, INITIAL_COMPANY_PRICES.get(company_name, 0.0))
+            current_ltp = ltp_get(company_name, initial_price)
             current_volume = COMPANY_VOLUME.get(company_name, 0)
-            current_vwap = CURRENT_VWAP_PRICES.get(company_name, INITIAL_COMPANY_PRICES.get(company_name, 0.0))
-
-            new_current_price = current_vwap
-            new_ltp_display = current_ltp
+            current_vwap = vwap_get(company_name, initial_price)
 
             if company_name in manual_overrides:
-                new_current_price = manual_overrides[company_name]
-                new_ltp_display = manual_overrides[company_name]
-                logging.info(f"  Manual override applied for {company_name}: setting price to {new_current_price:.2f}")
+                override_price = manual_overrides[company_name]
+                logging.info(f"  Manual override applied for {company_name}: setting price to {override_price:.2f}")
 
                 # === FIX: Clear the recent trade history to make the override the new baseline price. ===
                 RECENT_TRADES_HISTORY[company_name].clear()
                 logging.info(f"  Trade history for {company_name} cleared due to manual override.")
 
+                overridden_rows.append((i, company_name, override_price, override_price, current_volume))
             else:
-                base_price = CURRENT_VWAP_PRICES.get(company_name, INITIAL_COMPANY_PRICES.get(company_name, 0.0))
+                base_price = current_vwap
                 vwap_price_from_trades = calculate_vwap(company_name)
 
                 if vwap_price_from_trades is not None:
                     base_price = vwap_price_from_trades
 
-                percentage_fluctuation = base_price * (random.uniform(-0.015, 0.015))
-                fixed_fluctuation = random.uniform(-0.02, 0.02)
-                fluctuation = percentage_fluctuation + fixed_fluctuation
-                new_current_price = base_price + fluctuation
+                fluctuating_rows.append((i, company_name, base_price, current_ltp, current_volume))
 
-                if new_current_price < 0:
-                    new_current_price = 0.01
+        # Apply the random fluctuation to all non-overridden companies in one vectorized step
+        priced_rows = overridden_rows
+        if fluctuating_rows:
+            base_prices = np.fromiter((r[2] for r in fluctuating_rows), dtype=np.float64, count=len(fluctuating_rows))
+            percentage_fluctuation = base_prices * _RNG.uniform(-0.015, 0.015, size=base_prices.size)
+            fixed_fluctuation = _RNG.uniform(-0.02, 0.02, size=base_prices.size)
+            new_prices = base_prices + percentage_fluctuation + fixed_fluctuation
+            new_prices = np.where(new_prices < 0, 0.01, new_prices)
+            priced_rows = priced_rows + [(i, company_name, float(new_price), current_ltp, current_volume)
+                                         for (i, company_name, _, current_ltp, current_volume), new_price
+                                         in zip(fluctuating_rows, new_prices)]
 
-            upper_circuit = new_current_price * 1.20
-            lower_circuit = new_current_price * 0.80
+        updates = []
+        for i, company_name, new_current_price, new_ltp_display, current_volume in sorted(priced_rows):
+            upper_circuit = new_current_price * UPPER_CIRCUIT_FACTOR
+            lower_circuit = new_current_price * LOWER_CIRCUIT_FACTOR
 
             if new_current_price > upper_circuit:
                 new_current_price = upper_circuit
@@ -308,20 +474,49 @@ def update_price_chart():
             })
 
         if updates:
-            price_chart_ws.batch_update(updates)
+            _call_with_backoff(price_chart_ws.batch_update, updates, value_input_option='USER_ENTERED')
+        # Checkboxes are cleared only after the prices are written, so a failed write keeps the override pending
+        if pending_admin_updates:
+            _call_with_backoff(admin_ws.batch_update, pending_admin_updates, value_input_option='USER_ENTERED')
+        _dirty_prices = False
+
+        if updates:
             logging.info("Price chart updated successfully.")
         else:
             logging.info("No companies found to update in Price Chart.")
+        if pending_admin_updates:
+            logging.info(f"Cleared {len(pending_admin_updates)} manual override checkboxes.")
 
     except Exception as e:
         logging.error(f"Error updating price chart: '{e}'")
 
 
+# Set once the Price_Chart conditional formatting rules are known to be on the sheet
+_CF_INSTALLED = False
+
+
+def _conditional_format_rule_signature(rule):
+    """
+    Returns a stable signature for a conditional format rule based on its ranges and condition,
+    so rules already on the sheet can be matched against the ones this script would add.
+    """
+    return json.dumps({
+        "ranges": rule.get("ranges", []),
+        "condition": rule.get("booleanRule", {}).get("condition", {})
+    }, sort_keys=True)
+
+
 def apply_price_chart_conditional_formatting():
     """
     Applies conditional formatting rules to the 'Price_Chart' sheet.
-    This function should be called once on script startup as rules persist on the sheet.
+    This function should be called once on script startup as rules persist on the sheet;
+    rules that are already present on the sheet are not added again.
     """
+    global _CF_INSTALLED
+    if _CF_INSTALLED:
+        logging.debug("DEBUG: Conditional formatting already installed in this run. Skipping.")
+        return
+
     logging.info("Applying conditional formatting to Price Chart sheet.")
     try:
         price_chart_ws = get_worksheet(SHEET_MAPPING["Price_Chart"])
@@ -392,11 +587,29 @@ def apply_price_chart_conditional_formatting():
         }
         requests.append(rule_change_percent_down)
 
+        metadata = _call_with_backoff(price_chart_ws.spreadsheet.fetch_sheet_metadata, params={
+            'includeGridData': False,
+            'fields': 'sheets(properties.sheetId,conditionalFormats)'
+        })
+        existing_signatures = set()
+        for sheet in metadata.get('sheets', []):
+            if sheet.get('properties', {}).get('sheetId') == sheet_id:
+                existing_signatures = {_conditional_format_rule_signature(rule)
+                                       for rule in sheet.get('conditionalFormats', [])}
+                break
+
+        requests = [request for request in requests
+                    if _conditional_format_rule_signature(request["addConditionalFormatRule"]["rule"])
+                    not in existing_signatures]
+
         if requests:
-            price_chart_ws.batch_update({'requests': requests})
-            logging.info("Conditional formatting rules applied successfully.")
+            # Adding rules is not idempotent: a retry after a committed 5xx would add every rule twice
+            _call_with_backoff(price_chart_ws.spreadsheet.batch_update, {'requests': requests},
+                               retry_codes=NON_IDEMPOTENT_RETRY_CODES)
+            logging.info(f"Conditional formatting rules applied successfully ({len(requests)} added).")
         else:
-            logging.warning("No conditional formatting rules to apply.")
+            logging.info("Conditional formatting rules already present on Price Chart sheet.")
+        _CF_INSTALLED = True
 
     except gspread.exceptions.SpreadsheetNotFound:
         logging.error(f"Price Chart spreadsheet not found for conditional formatting.")
@@ -406,17 +619,68 @@ def apply_price_chart_conditional_formatting():
 
 # === MAIN TRADE PROCESSING LOGIC ===
 
+# BrokerTerminal order rows (below the header) and the columns the script reads: Order ID .. Process checkbox
+BROKER_ORDERS_RANGE = "A2:J"
+
+# Number of participant spreadsheets written concurrently at the end of a cycle
+PARTICIPANT_FLUSH_WORKERS = 4
+
+
+def _participant_cell_updates(data):
+    """
+    Returns the value updates for a participant's changed cash and holdings.
+    Only the cells the script owns (B2 and the holding quantities) are included, and only when this
+    cycle changed them, so a concurrent edit to any other cell is never overwritten.
+    """
+    owned_cell_updates = []
+
+    if data['cash'] != data['read_cash']:
+        owned_cell_updates.append({'range': 'B2', 'values': [[round(data['cash'], 2)]]})
+
+    for company, qty in data['holdings'].items():
+        if qty != data['read_holdings'].get(company):
+            owned_cell_updates.append({'range': f"B{data['holding_rows'][company]}", 'values': [[qty]]})
+
+    return owned_cell_updates
+
+
+def _flush_participant_spreadsheet(url, participants):
+    """
+    Writes the cash and holdings of every participant in one spreadsheet with a single values.batchUpdate,
+    then appends their new transactions. participants is a list of (participant_name, data) pairs.
+    Runs on a worker thread; errors are re-raised to the caller.
+    """
+    participant_ws = get_worksheet(url)
+    participant_names = [participant_name for participant_name, _ in participants]
+
+    cell_updates = []
+    for _, data in participants:
+        cell_updates.extend(_participant_cell_updates(data))
+
+    if cell_updates:
+        _call_with_backoff(participant_ws.batch_update, cell_updates, value_input_option='RAW')
+        logging.info(f"Updated cash and holdings for {', '.join(participant_names)}.")
+
+    for participant_name, data in participants:
+        if data['transactions_to_append_data']:
+            _call_with_backoff(participant_ws.append_rows, data['transactions_to_append_data'],
+                               retry_codes=NON_IDEMPOTENT_RETRY_CODES)
+            logging.info(
+                f"Appended {len(data['transactions_to_append_data'])} transactions for {participant_name}.")
+
+
 def process_trades():
     """
     This is the core function that orchestrates the trade simulation.
     """
-    logging.info(f"\n--- Starting trade processing cycle at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
-
-    _WORKSHEET_CACHE.clear()
+    global _dirty_prices
+    cycle_ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    logging.info(f"\n--- Starting trade processing cycle at {cycle_ts} ---")
 
     try:
         broker_ws = get_worksheet(SHEET_MAPPING["BrokerTerminal"])
-        orders = broker_ws.get_all_values()[1:]
+        # Only columns A:J are used; UNFORMATTED_VALUE returns numbers and checkboxes already typed
+        orders = _call_with_backoff(broker_ws.get, BROKER_ORDERS_RANGE, value_render_option='UNFORMATTED_VALUE')
     except Exception as e:
         logging.critical(f"Could not access BrokerTerminal sheet. Skipping this cycle. Error: {e}")
         return False
@@ -424,19 +688,21 @@ def process_trades():
     new_transactions_to_process = []
 
     for i, row in enumerate(orders, start=2):
-        if len(row) < 10:
-            if not any(cell.strip() for cell in row): continue
-            logging.warning(
-                f"  Incomplete row data at row {i}. Expected at least 10 columns, got {len(row)}. Skipping.")
+        # Column A (Order ID) is always filled on real orders, so a blank first cell marks an empty row
+        if not row or row[0] == "":
             continue
 
-        status = row[7].strip()
-        process_checkbox = row[9].strip().upper()
+        # The API drops trailing empty cells, so pad to the 10 order columns (as get_all_values used to).
+        # Strip text cells once per row; numbers and checkboxes arrive typed from the unformatted read
+        cells = [cell.strip() if isinstance(cell, str) else cell for cell in row[:10]]
+        cells += [""] * (10 - len(cells))
+        status = cells[7]
+        process_checkbox = str(cells[9]).upper()
 
         if status or process_checkbox != 'TRUE':
             continue
 
-        new_transactions_to_process.append((i, row))
+        new_transactions_to_process.append((i, cells))
 
     if not new_transactions_to_process:
         logging.info("No new fresh transactions marked for processing in this cycle.")
@@ -446,35 +712,47 @@ def process_trades():
     logging.info(f"Found {len(new_transactions_to_process)} new transactions marked for processing as a batch.")
 
     found_any_processed_in_batch = False
-    updates_to_broker_terminal = []
+
+    # One status/message entry per BrokerTerminal row, flushed as a single H:J (or G:J) range per row
+    broker_row_results = {}
+    corrected_totals = {}
+
+    def mark_row(row_index, status, message):
+        broker_row_results[row_index] = (status, message)
 
     participant_data_for_batch_update = {}
 
     all_participants_in_batch = set()
     for _, row_data in new_transactions_to_process:
         _, buyer, seller, _, _, _, _, _, _, _ = row_data
-        all_participants_in_batch.add(buyer.strip())
-        all_participants_in_batch.add(seller.strip())
+        all_participants_in_batch.add(buyer)
+        all_participants_in_batch.add(seller)
 
+    valid_participants = []
     for participant_name in all_participants_in_batch:
         if participant_name not in SHEET_MAPPING:
             logging.error(f"Invalid participant '{participant_name}' encountered. Skipping data pre-fetch.")
             continue
+        valid_participants.append(participant_name)
+
+    participant_blocks = fetch_participant_blocks(valid_participants)
 
+    for participant_name in valid_participants:
         try:
-            participant_ws = get_worksheet(SHEET_MAPPING[participant_name])
+            block = participant_blocks[participant_name]
+            if block is None:
+                raise ValueError(f"Could not read {PARTICIPANT_BLOCK_RANGE} block.")
+            cash = get_cash_balance(block, participant_name)
+            holdings = get_holdings(block, participant_name)
+            # The values as read are kept so only the cells this cycle changes are written back
             participant_data_for_batch_update[participant_name] = {
-                'cash': get_cash_balance(participant_ws),
-                'holdings': get_holdings(participant_ws),
-                'transactions_to_append_data': [],
-                'holding_cell_ranges': {}
+                'cash': cash,
+                'holdings': dict(holdings),
+                'read_cash': cash,
+                'read_holdings': holdings,
+                'holding_rows': get_holding_rows(block),
+                'transactions_to_append_data': []
             }
-            holdings_data_for_ranges = participant_ws.get("A6:B14")
-            for r_idx, h_row in enumerate(holdings_data_for_ranges):
-                if len(h_row) >= 1 and h_row[0].strip():
-                    company_name = h_row[0].strip().upper()
-                    participant_data_for_batch_update[participant_name]['holding_cell_ranges'][
-                        company_name] = f'B{r_idx + 6}'
 
         except Exception as e:
             logging.error(f"Error pre-fetching data for participant '{participant_name}': {e}")
@@ -482,41 +760,32 @@ def process_trades():
 
     for original_row_index, row_data in new_transactions_to_process:
         order_id, buyer, seller, company_raw, qty_str, price_str, total_str, _, _, _ = row_data
-        company = company_raw.strip().upper()
+        company = str(company_raw).upper()
 
         logging.info(f"Processing order in row {original_row_index} (Order ID: {order_id})...")
 
         try:
-            qty = int(qty_str)
+            qty = parse_quantity(qty_str)
             price = float(price_str)
             calculated_total = round(qty * price, 2)
             if not total_str or abs(float(total_str) - calculated_total) > 0.01:
-                updates_to_broker_terminal.append({'range': f'G{original_row_index}', 'values': [[calculated_total]]})
+                corrected_totals[original_row_index] = calculated_total
             total = calculated_total
         except (ValueError, TypeError) as e:
-            updates_to_broker_terminal.append({'range': f'H{original_row_index}', 'values': [["❌"]]})
-            updates_to_broker_terminal.append(
-                {'range': f'I{original_row_index}', 'values': [[f"Invalid qty or price: {e}"]]})
-            updates_to_broker_terminal.append({'range': f'J{original_row_index}', 'values': [['FALSE']]})
+            mark_row(original_row_index, "❌", f"Invalid qty or price: {e}")
             logging.error(
                 f"  Error in row {original_row_index}: Invalid quantity ('{qty_str}') or price ('{price_str}'). Error: {e}")
             continue
 
         if total < MIN_ORDER_VALUE:
-            updates_to_broker_terminal.append({'range': f'H{original_row_index}', 'values': [["❌"]]})
-            updates_to_broker_terminal.append(
-                {'range': f'I{original_row_index}', 'values': [[f"Order < ₹{MIN_ORDER_VALUE} (Total: {total:.2f})"]]})
-            updates_to_broker_terminal.append({'range': f'J{original_row_index}', 'values': [['FALSE']]})
+            mark_row(original_row_index, "❌", f"Order < ₹{MIN_ORDER_VALUE} (Total: {total:.2f})")
             logging.warning(
                 f"  Error in row {original_row_index}: Order value ({total:.2f}) is below minimum allowed ({MIN_ORDER_VALUE}).")
             continue
 
         if participant_data_for_batch_update.get(buyer) is None or participant_data_for_batch_update.get(
                 seller) is None:
-            updates_to_broker_terminal.append({'range': f'H{original_row_index}', 'values': [["❌"]]})
-            updates_to_broker_terminal.append(
-                {'range': f'I{original_row_index}', 'values': [[f"Participant sheet access error."]]})
-            updates_to_broker_terminal.append({'range': f'J{original_row_index}', 'values': [['FALSE']]})
+            mark_row(original_row_index, "❌", f"Participant sheet access error.")
             logging.error(
                 f"  Error in row {original_row_index}: Could not access cached data for buyer '{buyer}' or seller '{seller}'.")
             continue
@@ -526,10 +795,8 @@ def process_trades():
             upper_limit = company_circuits["upper"]
             lower_limit = company_circuits["lower"]
             if not (lower_limit <= price <= upper_limit):
-                updates_to_broker_terminal.append({'range': f'H{original_row_index}', 'values': [["❌"]]})
-                updates_to_broker_terminal.append({'range': f'I{original_row_index}', 'values': [
-                    [f"Price ₹{price:.2f} outside circuit ({lower_limit:.2f}-{upper_limit:.2f})"]]})
-                updates_to_broker_terminal.append({'range': f'J{original_row_index}', 'values': [['FALSE']]})
+                mark_row(original_row_index, "❌",
+                         f"Price ₹{price:.2f} outside circuit ({lower_limit:.2f}-{upper_limit:.2f})")
                 logging.warning(
                     f"  Error in row {original_row_index}: Order price '{price:.2f}' for '{company}' is outside circuit limits.")
                 continue
@@ -538,94 +805,88 @@ def process_trades():
         seller_current_holdings = participant_data_for_batch_update[seller]['holdings']
 
         if buyer_current_cash < total:
-            updates_to_broker_terminal.append({'range': f'H{original_row_index}', 'values': [["❌"]]})
-            updates_to_broker_terminal.append({'range': f'I{original_row_index}', 'values': [
-                [f"Insufficient cash (Buyer has {buyer_current_cash:.2f}, needs {total:.2f})"]]})
-            updates_to_broker_terminal.append({'range': f'J{original_row_index}', 'values': [['FALSE']]})
+            mark_row(original_row_index, "❌",
+                     f"Insufficient cash (Buyer has {buyer_current_cash:.2f}, needs {total:.2f})")
             logging.warning(f"  Error in row {original_row_index}: Buyer '{buyer}' has insufficient cash.")
             continue
 
         if company not in seller_current_holdings or seller_current_holdings[company] < qty:
-            updates_to_broker_terminal.append({'range': f'H{original_row_index}', 'values': [["❌"]]})
-            updates_to_broker_terminal.append({'range': f'I{original_row_index}', 'values': [
-                [f"Insufficient stock (Seller has {seller_current_holdings.get(company, 0)}, needs {qty})"]]})
-            updates_to_broker_terminal.append({'range': f'J{original_row_index}', 'values': [['FALSE']]})
+            mark_row(original_row_index, "❌",
+                     f"Insufficient stock (Seller has {seller_current_holdings.get(company, 0)}, needs {qty})")
             logging.warning(
                 f"  Error in row {original_row_index}: Seller '{seller}' has insufficient stock of '{company}'.")
             continue
 
+        # A bought quantity can only be recorded if the buyer's sheet has a holdings row for the company
+        if company not in participant_data_for_batch_update[buyer]['holdings']:
+            mark_row(original_row_index, "❌", f"Buyer sheet has no holdings row for {company}")
+            logging.warning(
+                f"  Error in row {original_row_index}: Buyer '{buyer}' has no holdings row for '{company}'.")
+            continue
+
         # === Execute Trade (Update local cache first) ===
         try:
             participant_data_for_batch_update[buyer]['cash'] -= total
             participant_data_for_batch_update[seller]['cash'] += total
 
-            participant_data_for_batch_update[buyer]['holdings'][company] = participant_data_for_batch_update[buyer][
-                                                                                'holdings'].get(company, 0) + qty
+            participant_data_for_batch_update[buyer]['holdings'][company] += qty
             participant_data_for_batch_update[seller]['holdings'][company] -= qty
 
             participant_data_for_batch_update[buyer]['transactions_to_append_data'].append(
-                prepare_transaction_row("BUY", company, qty, price, total)
+                prepare_transaction_row(cycle_ts, "BUY", company, qty, price, total)
             )
             participant_data_for_batch_update[seller]['transactions_to_append_data'].append(
-                prepare_transaction_row("SELL", company, qty, price, total)
+                prepare_transaction_row(cycle_ts, "SELL", company, qty, price, total)
             )
 
-            RECENT_TRADES_HISTORY[company].append((price, qty))
-            if len(RECENT_TRADES_HISTORY[company]) > 3:
-                RECENT_TRADES_HISTORY[company].pop(0)
+            RECENT_TRADES_HISTORY[company].push(price, qty)
             COMPANY_VOLUME[company] += qty
             LAST_TRADED_PRICES[company] = price
 
-            updates_to_broker_terminal.append({'range': f'H{original_row_index}', 'values': [["✅"]]})
-            updates_to_broker_terminal.append({'range': f'I{original_row_index}', 'values': [["Trade completed"]]})
-            updates_to_broker_terminal.append({'range': f'J{original_row_index}', 'values': [['FALSE']]})
+            mark_row(original_row_index, "✅", "Trade completed")
             logging.info(f"  Trade {order_id} completed successfully.")
             found_any_processed_in_batch = True
+            _dirty_prices = True
 
         except Exception as e:
-            updates_to_broker_terminal.append({'range': f'H{original_row_index}', 'values': [["❌"]]})
-            updates_to_broker_terminal.append(
-                {'range': f'I{original_row_index}', 'values': [[f"Trade execution failed: {e}"]]})
-            updates_to_broker_terminal.append({'range': f'J{original_row_index}', 'values': [['FALSE']]})
+            mark_row(original_row_index, "❌", f"Trade execution failed: {e}")
             logging.error(f"  Error executing trade {order_id}: {e}")
             continue
 
+    updates_to_broker_terminal = []
+    for row_index, (status, message) in broker_row_results.items():
+        if row_index in corrected_totals:
+            updates_to_broker_terminal.append(
+                {'range': f'G{row_index}:J{row_index}',
+                 'values': [[corrected_totals[row_index], status, message, 'FALSE']]})
+        else:
+            updates_to_broker_terminal.append(
+                {'range': f'H{row_index}:J{row_index}', 'values': [[status, message, 'FALSE']]})
+
     if updates_to_broker_terminal:
         try:
-            broker_ws.batch_update(updates_to_broker_terminal)
-            logging.info(f"Updated {len(updates_to_broker_terminal)} cells in BrokerTerminal.")
+            _call_with_backoff(broker_ws.batch_update, updates_to_broker_terminal, value_input_option='USER_ENTERED')
+            logging.info(f"Updated {len(updates_to_broker_terminal)} rows in BrokerTerminal.")
         except Exception as e:
             logging.error(f"Failed to perform batch update on BrokerTerminal: {e}")
 
+    # Group participants by spreadsheet, as fetch_participant_blocks does, so each spreadsheet gets one
+    # values.batchUpdate; different spreadsheets are independent and are written concurrently
+    participants_by_url = {}
     for participant_name, data in participant_data_for_batch_update.items():
-        if data is None:
-            continue
-
-        try:
-            participant_ws = get_worksheet(SHEET_MAPPING[participant_name])
-            participant_sheet_updates = []
-
-            participant_sheet_updates.append({'range': 'B2', 'values': [[round(data['cash'], 2)]]})
-
-            for company, qty in data['holdings'].items():
-                range_name = data['holding_cell_ranges'].get(company)
-                if range_name:
-                    participant_sheet_updates.append({'range': range_name, 'values': [[str(qty)]]})
-                else:
-                    logging.warning(
-                        f"Could not find range for company '{company}' in '{participant_name}' holdings for batch update.")
-
-            if participant_sheet_updates:
-                participant_ws.batch_update(participant_sheet_updates)
-                logging.info(f"Updated cash and holdings for {participant_name}.")
-
-            if data['transactions_to_append_data']:
-                participant_ws.append_rows(data['transactions_to_append_data'])
-                logging.info(
-                    f"Appended {len(data['transactions_to_append_data'])} transactions for {participant_name}.")
-
-        except Exception as e:
-            logging.error(f"Error performing batch updates for participant '{participant_name}': {e}")
+        if data is not None:
+            participants_by_url.setdefault(SHEET_MAPPING[participant_name], []).append((participant_name, data))
+
+    if participants_by_url:
+        with ThreadPoolExecutor(max_workers=PARTICIPANT_FLUSH_WORKERS) as pool:
+            futures = {pool.submit(_flush_participant_spreadsheet, url, participants): participants
+                       for url, participants in participants_by_url.items()}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    participant_names = [participant_name for participant_name, _ in futures[future]]
+                    logging.error(f"Error performing batch updates for participants {participant_names}: {e}")
 
     if not found_any_processed_in_batch:
         logging.info("No new transactions were processed in this batch.")
@@ -643,8 +904,8 @@ if __name__ == "__main__":
         PREVIOUS_PRICES[company] = price
         LAST_TRADED_PRICES[company] = price
         CURRENT_VWAP_PRICES[company] = price
-        CURRENT_CIRCUITS[company]["upper"] = price * 1.20
-        CURRENT_CIRCUITS[company]["lower"] = price * 0.80
+        CURRENT_CIRCUITS[company]["upper"] = price * UPPER_CIRCUIT_FACTOR
+        CURRENT_CIRCUITS[company]["lower"] = price * LOWER_CIRCUIT_FACTOR
 
     try:
         update_price_chart()
@@ -655,6 +916,7 @@ if __name__ == "__main__":
     CYCLE_INTERVAL_SECONDS = 10
 
     while True:
+        cycle_start = time.monotonic()
         try:
             process_trades()
         except Exception as e:
@@ -662,6 +924,13 @@ if __name__ == "__main__":
 
         update_price_chart()
 
-        logging.info(f"Waiting {CYCLE_INTERVAL_SECONDS} seconds before next full cycle...")
+        # Sleep only for what is left of the interval so cycles start at a fixed cadence
+        cycle_duration = time.monotonic() - cycle_start
+        sleep_for = CYCLE_INTERVAL_SECONDS - cycle_duration
+        if sleep_for <= 0:
+            logging.warning(
+                f"Cycle took {cycle_duration:.2f}s, overrunning the {CYCLE_INTERVAL_SECONDS}s interval. Starting next cycle immediately.")
+        else:
+            logging.info(f"Waiting {sleep_for:.2f} seconds before next full cycle...")
 
-        time.sleep(CYCLE_INTERVAL_SECONDS)
+        time.sleep(max(0, sleep_for))